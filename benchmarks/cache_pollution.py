@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Times hashing one file with each --no-cache-pollution mode and shows how
+much of it is left in the page cache afterwards.
+
+    python benchmarks/cache_pollution.py --size 4G /mnt/data
+"""
+
+import os
+import sys
+import mmap
+import time
+import ctypes
+import ctypes.util
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from zencrc import crc32  # noqa: E402
+from zencrc.throttle import parse_amount  # noqa: E402
+
+policies = (None, 'dontneed', 'direct')
+
+
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            left -= f.write(block[:min(left, len(block))])
+
+
+def drop_cache(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def resident(path):
+    # Share of the file's pages in the page cache, from mincore(2), or None
+    # where that can't be asked.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        size = os.path.getsize(path)
+        page = mmap.PAGESIZE
+        pages = -(-size // page)
+        vec = (ctypes.c_ubyte * pages)()
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY) as mm:
+            addr = ctypes.addressof(ctypes.c_char.from_buffer(mm))
+            if libc.mincore(ctypes.c_void_p(addr), ctypes.c_size_t(size),
+                            vec):
+                return None
+        return sum(v & 1 for v in vec) / pages
+    except (AttributeError, OSError, ValueError, TypeError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_amount, default=1 << 30)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('dir', nargs='?', default='.')
+    args = parser.parse_args()
+
+    path = os.path.join(args.dir, 'zencrc-bench-cache.bin')
+    make_file(path, args.size)
+    try:
+        expected = None
+        for policy in policies:
+            crc32.cache_policy = policy
+            best = None
+            for _ in range(args.runs):
+                drop_cache(path)
+                started = time.perf_counter()
+                crc = crc32.CRC32_from_file(path)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            expected = expected or crc
+            if crc != expected:
+                raise AssertionError('{} gave {}, not {}'.format(
+                    policy, crc, expected))
+            cached = resident(path)
+            print('{:10s} {:8.1f} MB/s  {} cached afterwards'.format(
+                policy or 'default', args.size / best / 1e6,
+                'n/a' if cached is None else '{:.0%}'.format(cached)))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
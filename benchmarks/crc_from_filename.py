@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Times the old crc_regex search against crc32.CRC_from_filename on paths of
+growing length, with and without a CRC in the name, then lists the names
+on which the two disagree.
+
+    python benchmarks/crc_from_filename.py --lengths 100,1000,10000
+"""
+
+import os
+import re
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from zencrc import crc32  # noqa: E402
+
+# crc_regex as it was before CRC_from_filename (git show 2c1bf12:zencrc/
+# crc32.py), used as re.search(crc_regex, path, re.I).group(2).
+crc_regex = r".*(\[|\()([0-f]{8})(\]|\))[^/]*"
+
+# (path, what the name holds). [0-f] spans '0' to 'f' in ASCII, so it
+# also takes : ; < = > ? @, the capitals and [ \ ] ^ _ `; and nothing
+# keeps the match out of the directory part.
+accuracy_cases = (
+    ('[Group] Show - 01 [ABCD1234].mkv', 'CRC'),
+    ('[Group] Show - 01 (abcd1234).mkv', 'lower case CRC'),
+    ('[Group] Show - 01 [12:4@6?8].mkv', 'no CRC, : @ ? in brackets'),
+    ('[Group] Show - 01 [GHIJKLMN].mkv', 'no CRC, capitals past F'),
+    ('Show [ABCD1234]/Show - 01.mkv', 'CRC in the directory only'),
+    ('[ABCD1234]/Show - 01 [0123ABCD].mkv', 'CRC in directory and name'),
+)
+
+
+def old_CRC_from_filename(path):
+    found = re.search(crc_regex, path, re.I)
+    return None if found is None else found.group(2).upper()
+
+
+def make_path(length, crc):
+    # Directories of bracketed words, the kind of name the old regex
+    # backtracks over, then a basename with or without a CRC.
+    name = 'Show - 01 [1080p]' + (' [ABCD1234]' if crc else '') + '.mkv'
+    parts = []
+    while sum(len(p) + 1 for p in parts) + len(name) < length:
+        parts.append('[Group] Season (2020)')
+    return '/'.join(parts + [name])
+
+
+def best_of(fn, path, runs):
+    timer = timeit.Timer(lambda: fn(path))
+    number, _ = timer.autorange()
+    return min(timer.repeat(runs, number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lengths', default='100,1000,10000')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>7s} {:6s} {:>12s} {:>12s} {:>9s}'.format(
+        'length', 'crc', 'crc_regex', 'scanner', 'speedup'))
+    for length in [int(n) for n in args.lengths.split(',')]:
+        for crc in (True, False):
+            path = make_path(length, crc)
+            if old_CRC_from_filename(path) != crc32.CRC_from_filename(path):
+                raise AssertionError('results differ on {!r}'.format(path))
+            old = best_of(old_CRC_from_filename, path, args.runs)
+            new = best_of(crc32.CRC_from_filename, path, args.runs)
+            print('{:7d} {:6s} {:10.2f}us {:10.2f}us {:8.1f}x'.format(
+                len(path), 'yes' if crc else 'no', old * 1e6, new * 1e6,
+                old / new))
+
+    print('\n{:38s} {:10s} {:10s} {}'.format(
+        'path', 'crc_regex', 'scanner', 'name holds'))
+    for path, holds in accuracy_cases:
+        print('{:38s} {:10s} {:10s} {}'.format(
+            path, str(old_CRC_from_filename(path)),
+            str(crc32.CRC_from_filename(path)), holds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Checks that split hashing matches zlib, then times one large file with
+--split-jobs 1, 2, 4, ... to show how range hashing scales on the disk
+holding DIR (point it at an NVMe mount).
+
+    python benchmarks/split.py --size 4G --jobs 1,2,4,8 /mnt/nvme
+"""
+
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from zencrc import crc32  # noqa: E402
+from zencrc.throttle import parse_amount  # noqa: E402
+
+
+def check_combine(rounds=200, seed=0):
+    # crc32_combine of random splits of random data against zlib.crc32 of
+    # the whole, including empty and single byte parts.
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        data = bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 4096)))
+        cut = rng.randint(0, len(data))
+        left, right = data[:cut], data[cut:]
+        combined = crc32.crc32_combine(zlib.crc32(left), zlib.crc32(right),
+                                       len(right))
+        if combined != zlib.crc32(data):
+            raise AssertionError('crc32_combine differs at {} of {}'.format(
+                cut, len(data)))
+
+
+def check_split(path, size, seed=0):
+    # CRC32_split with several job counts and odd chunk sizes, so ranges
+    # end at random points, against zlib.crc32 of the file.
+    rng = random.Random(seed)
+    with open(path, 'rb') as f:
+        expected = zlib.crc32(f.read())
+        fd = f.fileno()
+        for jobs in (1, 2, 3, 7, 16):
+            chunk_size = rng.randint(1, 64 * 1024)
+            got = crc32.CRC32_split(fd, size, jobs, chunk_size)
+            if got != expected:
+                raise AssertionError(
+                    'CRC32_split differs: jobs={} chunk_size={}'.format(
+                        jobs, chunk_size))
+
+
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            left -= f.write(block[:min(left, len(block))])
+
+
+def drop_cache(path):
+    # Clean pages can be dropped without root.
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_amount, default=1 << 30)
+    parser.add_argument('--jobs', default='1,2,4,8')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--warm', action='store_true',
+                        help='keep the file in the page cache between runs')
+    parser.add_argument('dir', nargs='?', default='.')
+    args = parser.parse_args()
+
+    check_combine()
+    path = os.path.join(args.dir, 'zencrc-bench-split.bin')
+    make_file(path, 3 * 1024 * 1024 + 12345)
+    try:
+        check_split(path, os.path.getsize(path))
+        print('crc32_combine and CRC32_split match zlib.crc32')
+        make_file(path, args.size)
+        crc32.split_threshold = 0
+        baseline = None
+        for jobs in [int(n) for n in args.jobs.split(',')]:
+            crc32.split_jobs = jobs
+            best = None
+            for _ in range(args.runs):
+                if not args.warm:
+                    drop_cache(path)
+                started = time.perf_counter()
+                crc32.CRC32_from_file(path)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            baseline = baseline or best
+            print('split-jobs {:3d}: {:8.1f} MB/s  x{:.2f}'.format(
+                jobs, args.size / best / 1e6, baseline / best))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
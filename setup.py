@@ -21,9 +21,10 @@ setup(
     include_package_data=True,
     zip_safe=False,
     platforms='any',
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
-            'zencrc = zencrc.zencrc_cli:main',
+            'zencrc = zencrc.client:main',
         ],
     },
     classifiers=[
@@ -34,6 +35,11 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Utilities '
     ]
 )
@@ -0,0 +1,258 @@
+import os
+import json
+import binascii
+from functools import partial
+from zencrc import crc32, workers
+
+# Bytes covered by one CRC in a block map.
+default_block_size = 4 * 1024 * 1024
+suffix = '.crcmap'
+
+
+def map_name(path):
+    return path + suffix
+
+
+def block_crcs(chunks, block_size):
+    # Splits a stream of chunks on block boundaries and yields the CRC of
+    # each block; the last one may be short.
+    crc = filled = 0
+    for chunk in chunks:
+        pos = 0
+        while pos < len(chunk):
+            take = min(block_size - filled, len(chunk) - pos)
+            crc = binascii.crc32(chunk[pos:pos + take], crc)
+            filled += take
+            pos += take
+            if filled == block_size:
+                yield crc
+                crc = filled = 0
+    if filled:
+        yield crc
+
+
+def build_tree(blocks, size, block_size):
+    # Level 0 is the blocks; each level above combines neighbours pairwise
+    # with crc32_combine, so every node is the CRC of the bytes under it
+    # and the root is the CRC32 of the whole file.
+    level = [(crc, min(block_size, size - i * block_size))
+             for i, crc in enumerate(blocks)]
+    tree = [level]
+    while len(level) > 1:
+        level = [_join(level[i:i + 2]) for i in range(0, len(level), 2)]
+        tree.append(level)
+    return tree
+
+
+def _join(pair):
+    if len(pair) == 1:
+        return pair[0]
+    (crc1, len1), (crc2, len2) = pair
+    return crc32.crc32_combine(crc1, crc2, len2), len1 + len2
+
+
+def merge_ranges(indexes, size, block_size):
+    # Turns sorted block indexes into (start, end) byte ranges.
+    ranges = []
+    for i in indexes:
+        start, end = i * block_size, min((i + 1) * block_size, size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+class BlockMap:
+    # A CRC32 per fixed-size block of a file plus the combined tree over
+    # them, saved as a JSON sidecar (FILE.crcmap).
+
+    def __init__(self, size, block_size, blocks, mtime_ns=None):
+        self.size = size
+        self.block_size = block_size
+        self.blocks = list(blocks)
+        self.mtime_ns = mtime_ns
+        self.tree = build_tree(self.blocks, size, block_size)
+
+    @property
+    def root(self):
+        return self.tree[-1][0][0] if self.blocks else 0
+
+    def digest(self):
+        return "%08X" % self.root
+
+    def update(self, index, crc):
+        # Replaces one block CRC and recomputes only its path to the root.
+        self.blocks[index] = crc
+        self.tree[0][index] = (crc, self.tree[0][index][1])
+        for depth in range(1, len(self.tree)):
+            index //= 2
+            below = self.tree[depth - 1]
+            self.tree[depth][index] = _join(below[index * 2:index * 2 + 2])
+
+    def damaged(self, other):
+        # Byte ranges where other (a fresh map of the file) differs.
+        indexes = [i for i, crc in enumerate(other.blocks)
+                   if i >= len(self.blocks) or self.blocks[i] != crc]
+        return merge_ranges(indexes, other.size, self.block_size)
+
+    @classmethod
+    def load(cls, path):
+        # Raises ValueError if the map can't be parsed or its tree doesn't
+        # match its blocks.
+        with open(path, encoding='utf-8') as sidecar:
+            try:
+                data = json.load(sidecar)
+                blocks = [int(crc, 16) for crc in data['blocks']]
+                block_map = cls(data['size'], data['block_size'], blocks,
+                                data.get('mtime_ns'))
+                stored = [[int(crc, 16) for crc in level]
+                          for level in data['tree']]
+            except (ValueError, KeyError, TypeError) as err:
+                raise ValueError('block map is damaged: {}: {}'.format(
+                    path, err)) from err
+        if stored != [[crc for crc, _ in level] for level in block_map.tree]:
+            raise ValueError('block map is damaged: {}'.format(path))
+        return block_map
+
+    def save(self, path):
+        data = {
+            'size': self.size,
+            'block_size': self.block_size,
+            'mtime_ns': self.mtime_ns,
+            'blocks': ['%08X' % crc for crc in self.blocks],
+            'tree': [['%08X' % crc for crc, _ in level]
+                     for level in self.tree],
+        }
+        tmp_name = path + '.tmp'
+        with open(tmp_name, encoding='utf-8', mode='w') as sidecar:
+            json.dump(data, sidecar, separators=(',', ':'))
+        os.replace(tmp_name, path)
+
+
+def map_file(file, block_size=None, chunk_size=None):
+    # Reads the whole file through the usual chunk loop.
+    block_size = block_size or default_block_size
+    with open(file, 'rb', buffering=0) as temp:
+        st = os.fstat(temp.fileno())
+        blocks = block_crcs(crc32.file_chunks(temp, chunk_size), block_size)
+        return BlockMap(st.st_size, block_size, blocks, st.st_mtime_ns)
+
+
+def remap_file(file, old, changed, chunk_size=None):
+    # Rereads only the blocks overlapping the changed (start, end) ranges,
+    # plus any block past the end of the old map, and reuses the rest.
+    # Returns the new map and the number of blocks read.
+    block_size = old.block_size
+    with open(file, 'rb', buffering=0) as temp:
+        fd = temp.fileno()
+        st = os.fstat(fd)
+        count = -(-st.st_size // block_size)
+        # A short last block, in the old map or the file, is always reread.
+        kept = min(st.st_size // block_size, old.size // block_size)
+        stale = set(range(kept, count))
+        for start, end in changed:
+            stale.update(range(start // block_size,
+                               min(-(-end // block_size), kept)))
+        blocks = old.blocks[:kept] + [0] * (count - kept)
+        new = BlockMap(st.st_size, block_size, blocks, st.st_mtime_ns)
+        for i in sorted(stale):
+            length = min(block_size, st.st_size - i * block_size)
+            new.update(i, crc32._crc32_range(fd, i * block_size, length,
+                                             chunk_size))
+        return new, len(stale)
+
+
+def write_map(record, changed=(), block_size=None):
+    # Creates or refreshes FILE.crcmap. An existing map whose size and
+    # mtime still match is trusted without reading; with changed ranges
+    # only those blocks are reread. Returns (map, blocks read).
+    record = crc32.as_record(record)
+    sidecar = map_name(record.path)
+    st = os.stat(record.path)
+    old = None
+    try:
+        old = BlockMap.load(sidecar)
+    except FileNotFoundError:
+        pass
+    except ValueError as err:
+        print(err)
+    if block_size and old is not None and old.block_size != block_size:
+        old = None
+    if old is not None and (old.size, old.mtime_ns) == (st.st_size,
+                                                        st.st_mtime_ns):
+        return old, 0
+    if old is not None and changed:
+        new, read = remap_file(record.path, old, changed)
+    else:
+        new = map_file(record.path, block_size or getattr(
+            old, 'block_size', None))
+        read = len(new.blocks)
+    new.save(sidecar)
+    return new, read
+
+
+def check_map(record):
+    # Rereads the file and compares it with FILE.crcmap. Returns
+    # (stored map, fresh map, damaged byte ranges).
+    record = crc32.as_record(record)
+    old = BlockMap.load(map_name(record.path))
+    new = map_file(record.path, old.block_size)
+    return old, new, old.damaged(new)
+
+
+def create_maps(files, jobs=1, changed=(), block_size=None):
+    # changed ranges apply to every file, so callers pass them with a
+    # single file only.
+    print('Block Map Mode:\n')
+    write = partial(write_map, changed=changed, block_size=block_size)
+    records = (i for i in map(crc32.as_record, files)
+               if not i.is_dir() and not i.path.endswith(suffix))
+    for record, pending in workers.imap_ordered(write, records, jobs):
+        try:
+            block_map, read = pending.result()
+        except OSError as err:
+            print(err)
+            continue
+        print('{} {} ({} of {} blocks read)'.format(
+            record.path, block_map.digest(), read, len(block_map.blocks)))
+
+
+def verify_maps(files, jobs=1):
+    print('Block Map Verify Mode:\n')
+    total_files = ok_files = damaged = bad_maps = missing = 0
+    records = (i for i in map(crc32.as_record, files)
+               if not i.is_dir() and not i.path.endswith(suffix))
+    for record, pending in workers.imap_ordered(check_map, records, jobs):
+        total_files += 1
+        print('{}:'.format(record.path))
+        try:
+            old, new, ranges = pending.result()
+        except FileNotFoundError as err:
+            print('No such file or directory: {}\n'.format(err.filename))
+            missing += 1
+            continue
+        except OSError as err:
+            print('{}\n'.format(err))
+            missing += 1
+            continue
+        except ValueError as err:
+            print('{}\n'.format(err))
+            bad_maps += 1
+            continue
+        if new.size != old.size:
+            print('Size changed: {} -> {}'.format(old.size, new.size))
+        if not ranges and new.size == old.size:
+            print('File OK\n')
+            ok_files += 1
+            continue
+        damaged += 1
+        for start, end in ranges:
+            print('Damaged bytes {}-{} ({} bytes)'.format(start, end - 1,
+                                                          end - start))
+        print()
+    print('\nSummary:\n Total - {}\n'.format(total_files),
+          'OK - {}\n'.format(ok_files),
+          'Damaged - {}\n'.format(damaged),
+          'Damaged map - {}\n'.format(bad_maps),
+          'No map or file - {}'.format(missing))
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import threading
+
+
+def default_path():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'zencrc', 'hashes.sqlite3')
+
+
+class HashCache:
+    # CRC32 values keyed by (st_dev, st_ino) and only trusted while size,
+    # mtime and ctime still match. WAL mode and a busy timeout let several
+    # zencrc processes share one database.
+
+    def __init__(self, path=None, refresh=False):
+        self.path = path or default_path()
+        self.refresh = refresh
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection()
+
+    def __getstate__(self):
+        return {'path': self.path, 'refresh': self.refresh}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite3 connections must not cross threads or forked processes.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                             'dev INTEGER, ino INTEGER, size INTEGER, '
+                             'mtime_ns INTEGER, ctime_ns INTEGER, '
+                             'crc32 TEXT, PRIMARY KEY (dev, ino))')
+                conn.execute('CREATE TABLE IF NOT EXISTS resume ('
+                             'dev INTEGER, ino INTEGER, offset INTEGER, '
+                             'crc32 INTEGER, tail_crc32 INTEGER, '
+                             'PRIMARY KEY (dev, ino))')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, st):
+        if self.refresh:
+            return None
+        try:
+            row = self._connection().execute(
+                'SELECT crc32 FROM hashes WHERE dev=? AND ino=? AND size=? '
+                'AND mtime_ns=? AND ctime_ns=?',
+                (st.st_dev, st.st_ino, st.st_size,
+                 st.st_mtime_ns, st.st_ctime_ns)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def get_resume(self, st):
+        # (offset, crc, tail_crc) saved for this inode by put_resume, or
+        # None if the file is now shorter than the saved offset.
+        if self.refresh:
+            return None
+        try:
+            row = self._connection().execute(
+                'SELECT offset, crc32, tail_crc32 FROM resume '
+                'WHERE dev=? AND ino=? AND offset<=?',
+                (st.st_dev, st.st_ino, st.st_size)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row
+
+    def put_resume(self, st, offset, crc, tail_crc):
+        try:
+            with self._connection() as conn:
+                conn.execute('INSERT OR REPLACE INTO resume '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (st.st_dev, st.st_ino, offset, crc, tail_crc))
+        except sqlite3.Error:
+            pass
+
+    def put(self, st, crc):
+        try:
+            with self._connection() as conn:
+                conn.execute('INSERT OR REPLACE INTO hashes '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (st.st_dev, st.st_ino, st.st_size,
+                              st.st_mtime_ns, st.st_ctime_ns, crc))
+        except sqlite3.Error:
+            pass
@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import socket
+
+# The zencrc entry point. It only imports what talking to a running
+# `zencrc serve` needs, so `zencrc client` starts quickly; everything else
+# is handed to zencrc_cli, imported on demand.
+
+
+def socket_path():
+    path = os.environ.get('ZENCRC_SOCKET')
+    if path:
+        return path
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, 'zencrc.sock')
+    # Next to the hash cache (cache.default_path()).
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'zencrc', 'zencrc.sock')
+
+
+def send(conn, **message):
+    conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def forward(argv, path=None):
+    # Sends argv to a running server and relays its output. Raises OSError
+    # if no server is listening.
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path or socket_path())
+        send(sock, argv=argv, cwd=os.getcwd())
+        for line in sock.makefile('rb'):
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+            elif 'exit' in message:
+                return message['exit']
+    return 1
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['client']:
+        # Run the rest in the server, or here if none is up.
+        try:
+            return forward(argv[1:])
+        except (ConnectionRefusedError, FileNotFoundError):
+            argv = argv[1:]
+    from zencrc import zencrc_cli
+    return zencrc_cli.main(argv)
+
+
+if (__name__ == '__main__'):
+    sys.exit(main())
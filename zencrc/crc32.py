@@ -1,116 +1,889 @@
 #!/usr/bin/env python3
 
 import os
-import re
+import mmap
+import queue
+import time
+import hashlib
 import binascii
+import threading
 from os.path import splitext
+from stat import S_ISDIR, S_ISREG
 from datetime import datetime
+from functools import lru_cache, partial
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from zencrc import inotify, manifest, throttle as throttling, workers, xattrs
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Global Var
-crc_regex = r".*(\[|\()([0-f]{8})(\]|\))[^/]*"
+# A compiled regex whose group 1 (or whole match) is the CRC in a file
+# name, or None for the built-in [XXXXXXXX]/(XXXXXXXX) scanner.
+crc_pattern = None
+hex_digits = frozenset('0123456789abcdefABCDEF')
+default_chunk_size = 1024 * 1024
+# Files at least this large are hashed as split_jobs ranges at once.
+split_threshold = 1024 ** 3
+split_jobs = 1
+# Range size used when idle workers may steal parts of a large file.
+steal_range_size = 64 * 1024 * 1024
+default_engine = 'read'
+readahead_depth = 4
+# Size of each mapping used by the mmap engine.
+mmap_window = 64 * 1024 * 1024
+# None, 'dontneed' (drop hashed pages from the page cache) or 'direct'
+# (O_DIRECT reads that bypass it).
+cache_policy = None
+drop_window = 8 * 1024 * 1024
+direct_alignment = 4096
+# A throttle.Throttle charged for every chunk read, or None.
+throttle = None
+# A cache.HashCache consulted by hash_record, or None to always hash.
+cache = None
+# Resume hashing of files that only grew since the last run, using the
+# running CRC the hash cache saved at the old end of file.
+resume_appends = False
+# Bytes before the saved offset that must still match for a resume.
+resume_tail_size = 64 * 1024
+# None leaves xattrs alone, 'trust' reads and writes them, 'rehash' only
+# writes them.
+xattr_policy = None
+# SFV lines are written in batches of this many.
+sfv_batch_lines = 1024
+# Digests that --hash can compute in the same pass as the CRC32.
+hash_algorithms = ('crc32', 'md5', 'sha1', 'sha224', 'sha256', 'sha384',
+                   'sha512')
+# Module settings copied into worker processes.
+worker_settings = ('crc_pattern', 'default_chunk_size', 'split_threshold',
+                   'split_jobs', 'steal_range_size', 'default_engine',
+                   'readahead_depth', 'mmap_window', 'cache_policy',
+                   'throttle', 'cache', 'resume_appends', 'xattr_policy')
+
+
+def settings():
+    return {name: globals()[name] for name in worker_settings}
+
+
+def configure(values):
+    globals().update(values)
 
 
 class FileObj:
-    pass
+    # One record per file, created by the walker (or from an SFV line) and
+    # passed through every stage, so each file is stat'ed at most once.
+    __slots__ = ('path', 'stat', 'expected', 'algorithm', 'crc', 'source',
+                 'digests')
+
+    def __init__(self, path, stat=None, expected=None, algorithm='crc32'):
+        self.path = path
+        self.stat = stat
+        self.expected = expected
+        self.algorithm = algorithm
+        self.crc = None
+        self.source = None
+        self.digests = None
+
+    def __fspath__(self):
+        return self.path
+
+    @classmethod
+    def from_path(cls, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        return cls(path, st)
+
+    def is_dir(self):
+        return self.stat is not None and S_ISDIR(self.stat.st_mode)
+
+    def digest(self):
+        # The computed value of self.algorithm.
+        if self.algorithm == 'crc32':
+            return self.crc
+        return self.digests[self.algorithm]
+
+
+def as_record(file):
+    if isinstance(file, FileObj):
+        return file
+    return FileObj(os.fspath(file))
+
+
+def read_chunks(fileobj, chunk_size=None):
+    # Yields views into one reused buffer, so each chunk is only valid
+    # until the next one is requested.
+    buf = bytearray(chunk_size or default_chunk_size)
+    view = memoryview(buf)
+    while True:
+        size = fileobj.readinto(buf)
+        if not size:
+            break
+        yield view[:size]
+
 
+def readahead_chunks(fileobj, chunk_size=None):
+    # A reader thread fills a small ring of buffers while the caller hashes
+    # the previous one, so disk and CPU work overlap.
+    free = queue.Queue()
+    full = queue.Queue()
+    for _ in range(readahead_depth):
+        free.put(bytearray(chunk_size or default_chunk_size))
 
-def CRC32_from_file(file):
-    with open(file, 'rb') as temp:
-        temp = (binascii.crc32(temp.read()) & 0xFFFFFFFF)
-        return "%08X" % temp
+    def reader():
+        try:
+            while True:
+                buf = free.get()
+                if buf is None:
+                    break
+                size = fileobj.readinto(buf)
+                full.put((buf, size))
+                if not size:
+                    break
+        except Exception as err:
+            full.put((err, 0))
 
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            buf, size = full.get()
+            if isinstance(buf, Exception):
+                raise buf
+            if not size:
+                break
+            yield memoryview(buf)[:size]
+            free.put(buf)
+    finally:
+        free.put(None)
+        thread.join()
+
+
+def mmap_chunks(fileobj, chunk_size=None):
+    # Maps the file a window at a time and yields memoryview slices of the
+    # mapping, so no data is copied into Python bytes. Pipes, special files
+    # and empty files fall back to read_chunks.
+    chunk_size = chunk_size or default_chunk_size
+    fd = fileobj.fileno()
+    st = os.fstat(fd)
+    if not S_ISREG(st.st_mode) or st.st_size <= fileobj.tell():
+        yield from read_chunks(fileobj, chunk_size)
+        return
+    start = fileobj.tell()
+    window = max(mmap_window // mmap.ALLOCATIONGRANULARITY, 1)
+    window *= mmap.ALLOCATIONGRANULARITY
+    offset = start - start % mmap.ALLOCATIONGRANULARITY
+    skip = start - offset
+    while offset < st.st_size:
+        length = min(window, st.st_size - offset)
+        try:
+            mm = mmap.mmap(fd, length, access=mmap.ACCESS_READ,
+                           offset=offset)
+        except (OSError, ValueError):
+            fileobj.seek(offset + skip)
+            yield from read_chunks(fileobj, chunk_size)
+            return
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            for pos in range(skip, length, chunk_size):
+                chunk = view[pos:pos + chunk_size]
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()
+        finally:
+            view.release()
+            mm.close()
+        offset += length
+        skip = 0
+    fileobj.seek(st.st_size)
 
-def verify_in_filename(files):
+
+engines = {
+    'read': read_chunks,
+    'readahead': readahead_chunks,
+    'mmap': mmap_chunks,
+}
+
+
+def _drop_cache(fd, offset, length):
     try:
-        filename = str(files[files.rfind("/") + 1:])
-        filename = filename[0:44] + '...'
-        filename_crc = re.search(crc_regex, files, re.I)
-        filename_crc = str.upper(filename_crc.group(2))
-        current = CRC32_from_file(files)
-        if (filename_crc == current):
-            status = 'File Ok'
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError):
+        pass
+
+
+def drop_behind(fd, chunks, offset=0):
+    # Drops pages that have already been hashed from the page cache every
+    # drop_window bytes, so a scan of cold data doesn't evict hot data.
+    dropped = offset
+    for chunk in chunks:
+        size = len(chunk)
+        yield chunk
+        offset += size
+        if offset - dropped >= drop_window:
+            _drop_cache(fd, dropped, offset - dropped)
+            dropped = offset
+    _drop_cache(fd, dropped, 0)
+
+
+def direct_chunks(fileobj, chunk_size=None):
+    # O_DIRECT reads into a page-aligned anonymous mapping that is reused
+    # for every chunk. Where O_DIRECT isn't supported (tmpfs, pipes,
+    # unaligned start) this falls back to drop_behind reads.
+    fd = fileobj.fileno()
+    size = chunk_size or default_chunk_size
+    size = -(-size // direct_alignment) * direct_alignment
+    try:
+        start = fileobj.tell()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        if start % direct_alignment:
+            raise ValueError(start)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+    except (AttributeError, OSError, ValueError):
+        yield from _dropping_chunks(fileobj, chunk_size)
+        return
+    buf = mmap.mmap(-1, size)
+    view = memoryview(buf)
+    try:
+        while True:
+            try:
+                got = fileobj.readinto(buf)
+            except OSError:
+                if fileobj.tell() != start:
+                    raise
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+                yield from _dropping_chunks(fileobj, chunk_size)
+                return
+            if not got:
+                break
+            chunk = view[:got]
+            try:
+                yield chunk
+            finally:
+                chunk.release()
+    finally:
+        view.release()
+        buf.close()
+
+
+def _dropping_chunks(fileobj, chunk_size=None):
+    try:
+        offset = fileobj.tell()
+    except OSError:
+        return engines[default_engine](fileobj, chunk_size)
+    return drop_behind(fileobj.fileno(),
+                       engines[default_engine](fileobj, chunk_size), offset)
+
+
+def file_chunks(fileobj, chunk_size=None):
+    # The selected engine, wrapped according to cache_policy and throttle.
+    if cache_policy == 'direct':
+        chunks = direct_chunks(fileobj, chunk_size)
+    elif cache_policy == 'dontneed':
+        chunks = _dropping_chunks(fileobj, chunk_size)
+    else:
+        chunks = engines[default_engine](fileobj, chunk_size)
+    if throttle is not None:
+        chunks = throttling.throttled(chunks, throttle)
+    return chunks
+
+
+def prefetch(file):
+    # Hint the kernel to start reading the next file while this one is
+    # still being hashed.
+    if default_engine != 'readahead' or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def pread_chunks(fd, offset, length, chunk_size=None):
+    # Positional reads leave the shared file offset alone, so several
+    # threads can read different ranges of one descriptor.
+    buf = bytearray(chunk_size or default_chunk_size)
+    view = memoryview(buf)
+    end = offset + length
+    while offset < end:
+        want = min(len(buf), end - offset)
+        if hasattr(os, 'preadv'):
+            size = os.preadv(fd, [view[:want]], offset)
         else:
-            status = 'File Corrupt'
-        print('{:49s} {:20s}{:8s}'.format(filename,
-                                          status,
-                                          current))
-    except AttributeError as err:
-        status = 'No CRC32 found'
-        current = CRC32_from_file(files)
-        print('{:49s} {:20s}{:8s}'.format(filename,
-                                          status,
-                                          current))
+            data = os.pread(fd, want, offset)
+            size = len(data)
+            view[:size] = data
+        if not size:
+            break
+        offset += size
+        yield view[:size]
+
+
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, row) for row in mat]
+
+
+@lru_cache(maxsize=64)
+def _crc32_zeros_operator(length):
+    # The GF(2) matrix that advances a CRC over `length` zero bytes, built
+    # by repeated squaring of the one-zero-byte operator. Cached, since a
+    # split file has at most two distinct range lengths.
+    op = [1 << n for n in range(32)]
+    square = [0xEDB88320] + [1 << n for n in range(31)]
+    for _ in range(3):
+        square = _gf2_matrix_square(square)
+    while length:
+        if length & 1:
+            op = [_gf2_matrix_times(square, row) for row in op]
+        length >>= 1
+        if length:
+            square = _gf2_matrix_square(square)
+    return op
+
+
+def crc32_combine(crc1, crc2, len2):
+    # Same result as zlib's crc32_combine(): the CRC of A + B given
+    # crc(A), crc(B) and len(B), found by applying len2 zero bytes to crc1.
+    if len2 <= 0:
+        return crc1
+    return _gf2_matrix_times(_crc32_zeros_operator(len2), crc1) ^ crc2
+
+
+def _crc32_range(fd, offset, length, chunk_size=None):
+    crc = 0
+    chunks = pread_chunks(fd, offset, length, chunk_size)
+    if cache_policy is not None:
+        chunks = drop_behind(fd, chunks, offset)
+    if throttle is not None:
+        chunks = throttling.throttled(chunks, throttle)
+    for chunk in chunks:
+        crc = binascii.crc32(chunk, crc)
+    return crc
+
+
+def split_ranges(size, parts, chunk_size=None):
+    chunk_size = chunk_size or default_chunk_size
+    step = -(-size // parts)
+    step = max(-(-step // chunk_size) * chunk_size, chunk_size)
+    return [(offset, min(step, size - offset))
+            for offset in range(0, size, step)]
+
+
+class RangeJob:
+    # The ranges of one file. The thread that owns the file and any idle
+    # worker helping it claim ranges one at a time, so work is shared
+    # until the last range is taken.
+
+    def __init__(self, fd, ranges, chunk_size=None):
+        self.fd = fd
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.crcs = [None] * len(ranges)
+        self.claimed = 0
+        self.finished = 0
+        self.error = None
+        self.cond = threading.Condition()
+
+    def help(self):
+        # Hashes one unclaimed range; returns False if none are left.
+        with self.cond:
+            if self.claimed >= len(self.ranges):
+                return False
+            index = self.claimed
+            self.claimed += 1
+        offset, length = self.ranges[index]
+        error = crc = None
+        try:
+            crc = _crc32_range(self.fd, offset, length, self.chunk_size)
+        except Exception as err:
+            error = err
+        with self.cond:
+            self.crcs[index] = crc
+            self.error = self.error or error
+            self.finished += 1
+            self.cond.notify_all()
+        return True
+
+    def help_all(self):
+        while self.help():
+            pass
+
+    def result(self):
+        self.help_all()
+        with self.cond:
+            while self.finished < len(self.ranges):
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        crc = 0
+        for (_, length), part in zip(self.ranges, self.crcs):
+            crc = crc32_combine(crc, part, length)
+        return crc
+
+
+def CRC32_split(fd, size, jobs, chunk_size=None):
+    job = RangeJob(fd, split_ranges(size, jobs, chunk_size), chunk_size)
+    with ThreadPoolExecutor(max_workers=max(jobs - 1, 1)) as pool:
+        for _ in range(jobs - 1):
+            pool.submit(job.help_all)
+        return job.result()
+
+
+def CRC32_shared(fd, size, board, chunk_size=None):
+    # Posts the file's ranges on a workers.HelpBoard so idle workers of a
+    # scheduled run can steal them.
+    parts = max(-(-size // steal_range_size), 1)
+    job = RangeJob(fd, split_ranges(size, parts, chunk_size), chunk_size)
+    board.post(job)
+    try:
+        return job.result()
+    finally:
+        board.remove(job)
+
+
+def CRC32_from_file(file, chunk_size=None, size=None):
+    crc = 0
+    board = workers.board
+    with open(file, 'rb', buffering=0) as temp:
+        if split_jobs > 1 or board is not None:
+            if size is None:
+                size = os.fstat(temp.fileno()).st_size
+            if size >= split_threshold:
+                if board is not None:
+                    crc = CRC32_shared(temp.fileno(), size, board,
+                                       chunk_size)
+                else:
+                    crc = CRC32_split(temp.fileno(), size, split_jobs,
+                                      chunk_size)
+                return "%08X" % (crc & 0xFFFFFFFF)
+        for chunk in file_chunks(temp, chunk_size):
+            crc = binascii.crc32(chunk, crc)
+    return "%08X" % (crc & 0xFFFFFFFF)
+
+
+def resume_CRC32(file, state=None, chunk_size=None):
+    # Continues from state = (offset, crc, tail_crc) when the resume_tail_size
+    # bytes before offset still have the CRC tail_crc, otherwise hashes from
+    # the start. Returns the new (offset, crc, tail_crc) for the file's
+    # current end and the offset reading started at (0 for a full read).
+    offset, crc = 0, 0
+    with open(file, 'rb', buffering=0) as temp:
+        fd = temp.fileno()
+        if state is not None:
+            start = max(state[0] - resume_tail_size, 0)
+            if _crc32_range(fd, start, state[0] - start) == state[2]:
+                offset, crc = state[0], state[1]
+        resumed_at = offset
+        temp.seek(offset)
+        for chunk in file_chunks(temp, chunk_size):
+            crc = binascii.crc32(chunk, crc)
+            offset += len(chunk)
+        start = max(offset - resume_tail_size, 0)
+        state = offset, crc, _crc32_range(fd, start, offset - start)
+        return state, resumed_at
+
+
+def follow_CRC32(file, idle=10.0, chunk_size=None):
+    # Keeps a running CRC while the file grows, like tail -f, and returns
+    # (crc, size) once a writer closes it (inotify IN_CLOSE_WRITE) or
+    # nothing has been written for `idle` seconds. Without inotify the
+    # file is polled. A file that shrinks is hashed again from the start.
+    crc = offset = 0
+    watcher = None
+    if inotify.available():
+        watcher = inotify.Inotify()
+    try:
+        if watcher is not None:
+            watcher.add_watch(file,
+                              inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE)
+        with open(file, 'rb', buffering=0) as temp:
+            last = time.monotonic()
+            closed = False
+            while True:
+                if os.fstat(temp.fileno()).st_size < offset:
+                    temp.seek(0)
+                    crc = offset = 0
+                for chunk in file_chunks(temp, chunk_size):
+                    crc = binascii.crc32(chunk, crc)
+                    offset += len(chunk)
+                    last = time.monotonic()
+                remaining = idle - (time.monotonic() - last)
+                if closed or remaining <= 0:
+                    break
+                if watcher is None:
+                    time.sleep(min(remaining, 0.5))
+                    continue
+                for _, mask, _, _ in watcher.read(remaining):
+                    if mask & inotify.IN_CLOSE_WRITE:
+                        closed = True
+    finally:
+        if watcher is not None:
+            watcher.close()
+    return "%08X" % (crc & 0xFFFFFFFF), offset
+
+
+def digest_file(file, algorithms, chunk_size=None):
+    # Feeds every chunk to all requested hashers, so the file is read once
+    # however many digests are wanted.
+    crc = 0
+    hashers = [hashlib.new(name) for name in algorithms if name != 'crc32']
+    with open(file, 'rb', buffering=0) as temp:
+        for chunk in file_chunks(temp, chunk_size):
+            if 'crc32' in algorithms:
+                crc = binascii.crc32(chunk, crc)
+            for hasher in hashers:
+                hasher.update(chunk)
+    digests = {hasher.name: hasher.hexdigest() for hasher in hashers}
+    if 'crc32' in algorithms:
+        digests['crc32'] = "%08X" % (crc & 0xFFFFFFFF)
+    return digests
+
+
+def hash_record(record, chunk_size=None, algorithms=None):
+    # Fills in record.crc and record.source ('xattr', 'cache', 'resume' or
+    # 'hash'), and record.digests when algorithms other than crc32 are
+    # asked for.
+    record = as_record(record)
+    if algorithms and tuple(algorithms) != ('crc32',):
+        record.digests = digest_file(record.path, algorithms, chunk_size)
+        record.crc = record.digests.get('crc32')
+        record.source = 'hash'
+        if record.crc is not None and record.stat is not None:
+            _store(record, record.crc)
+        return record
+    if cache is None and xattr_policy is None:
+        size = record.stat.st_size if record.stat else None
+        record.crc = CRC32_from_file(record.path, chunk_size, size)
+        record.source = 'hash'
+        return record
+    if record.stat is None:
+        record.stat = os.stat(record.path)
+    st = record.stat
+    if xattr_policy == 'trust':
+        crc = xattrs.read(record.path, st)
+        if crc is not None:
+            record.crc, record.source = crc, 'xattr'
+            return record
+    crc = cache.get(st) if cache is not None else None
+    if crc is not None:
+        if xattr_policy is not None:
+            _store(record, crc)
+        record.crc, record.source = crc, 'cache'
+        return record
+    if resume_appends and cache is not None:
+        state, resumed_at = resume_CRC32(record.path, cache.get_resume(st),
+                                         chunk_size)
+        cache.put_resume(st, *state)
+        crc = "%08X" % (state[1] & 0xFFFFFFFF)
+        if resumed_at:
+            # The bytes before resumed_at were not read again, so the CRC
+            # stays in the resume table and out of hashes and the xattr.
+            record.crc, record.source = crc, 'resume'
+            return record
+    else:
+        crc = CRC32_from_file(record.path, chunk_size, st.st_size)
+    _store(record, crc)
+    record.crc, record.source = crc, 'hash'
+    return record
+
+
+def _store(record, crc):
+    # The xattr is written first: setxattr changes the file's ctime, which
+    # is part of the cache key, so the cache entry uses a fresh stat (as
+    # long as size and mtime show the data itself is unchanged).
+    st = record.stat
+    if xattr_policy is not None:
+        xattrs.write(record.path, st, crc)
+        try:
+            fresh = os.stat(record.path)
+        except OSError:
+            return
+        if (fresh.st_size, fresh.st_mtime_ns) != (st.st_size,
+                                                  st.st_mtime_ns):
+            return
+        record.stat = st = fresh
+    if cache is not None:
+        cache.put(st, crc)
+
+
+def get_CRC32(file, chunk_size=None):
+    return hash_record(file, chunk_size).crc
+
+
+def CRC_from_filename(path):
+    # Returns the last bracketed 8-hex-digit token in the basename, upper
+    # cased, or None. Scans from the right, so the cost is linear in the
+    # length of the name and the directory part is never looked at.
+    name = path[path.rfind('/') + 1:]
+    if crc_pattern is not None:
+        found = None
+        for found in crc_pattern.finditer(name):
+            pass
+        if found is None:
+            return None
+        return (found.group(1) if found.re.groups else found.group()).upper()
+    end = len(name)
+    while True:
+        close = max(name.rfind(']', 0, end), name.rfind(')', 0, end))
+        if close < 9:
+            return None
+        token = name[close - 8:close]
+        if name[close - 9] in '[(' and hex_digits.issuperset(token):
+            return token.upper()
+        end = close
+
+
+def verify_in_filename(record, pending=None):
+    record = as_record(record)
+    files = record.path
+    filename = str(files[files.rfind("/") + 1:])
+    filename = filename[0:44] + '...'
+    try:
+        record = pending.result() if pending else hash_record(record)
     except FileNotFoundError as err:
         print(err)
+        return
+    filename_crc = CRC_from_filename(files)
+    if filename_crc is not None:
+        record.expected = filename_crc
+    if record.expected is None:
+        status = 'No CRC32 found'
+    elif record.expected == record.crc:
+        status = {'hash': 'File Ok',
+                  'resume': 'Resumed OK'}.get(record.source, 'Cached OK')
+    else:
+        status = 'File Corrupt'
+    print('{:49s} {:20s}{:8s}'.format(filename,
+                                      status,
+                                      record.crc))
+
+
+def hash_unless_named(record):
+    record = as_record(record)
+    if CRC_from_filename(record.path):
+        return record
+    return hash_record(record)
 
 
-def append_to_filename(file_in):
+def append_to_filename(record, pending=None):
+    record = as_record(record)
+    file_in = record.path
     try:
-        already_appended = re.search(crc_regex, file_in, re.I)
+        already_appended = CRC_from_filename(file_in)
         if already_appended:
             print (file_in[file_in.rfind("/") + 1:],
                    ': already contains a CRC32 in file name.')
         else:
             print('{} ...'.format(file_in))
-            crc = CRC32_from_file(file_in)
+            record = pending.result() if pending else hash_record(record)
+            crc = record.crc
             basename, ext = splitext(file_in)
-            os.rename(file_in, '{} [{}]{}'.format(basename, crc, ext))
+            new_name = '{} [{}]{}'.format(basename, crc, ext)
+            os.rename(file_in, new_name)
             print (crc + ' Done')
+            return new_name
     except FileNotFoundError:
         print('No such file or directory:', file_in)
 
 
-def verify_sfv_file(file_in):
-    with open(file_in, 'r') as f:
-        text = f.read().split('\n')
-        total_files = ok_files = corrupt = not_found = 0
-        for line in text:
-            line = line.rstrip()
-            if(len(line) != 0 and line[0] != ';'):
-                crc = line[line.rfind(" ") + 1:]
-                cur_file = line[0:-9]
-                total_files += 1
-                try:
-                    calc_crc = str.upper(CRC32_from_file(cur_file))
-                    if(calc_crc == crc.upper()):
-                        cur_file = cur_file[cur_file.rfind('/') + 1:]
-                        print('{}:\nFile OK\n'.format(cur_file))
-                        ok_files += 1
-                    else:
-                        cur_file = cur_file[cur_file.rfind('/') + 1:]
-                        print('{}:\nCorrupt file\n'.format(cur_file))
-                        corrupt += 1
-                except FileNotFoundError:
-                    print(cur_file + ':')
-                    print('No such file or directory: {}'.format(cur_file))
-                    not_found += 1
-        print('\nSummary:\n Total - {}\n'.format(total_files),
-              'OK - {}\n'.format(ok_files),
-              'Corrupt - {}\n'.format(corrupt),
-              'Not Found - {}'.format(not_found))
-
-
-def create_sfv_file(sfv_filename, in_files):
-    print('Creating {}...'.format(sfv_filename))
-    with open(sfv_filename, encoding='utf-8', mode='w+') as buf:
-        ctime = datetime.now().strftime('%A, %d %B %Y @ %I:%M %p')
-        nline = '\n;'
-        char = 'charset=UTF-8'
-        hasht = 'Hash type: CRC-32'
-        head = '; Created by SFV Master 1.2{1} {0}{1} {2}{1} {3}{1}\n'.format(
-            ctime,
-            nline,
-            char,
-            hasht)
-
-        buf.write(head)
-        for fname in in_files:
-            if(fname[-4:] != '.sfv'):
-                try:
-                    file_crc = CRC32_from_file(fname)
-                    buf.write('{} {}\n'.format(fname, file_crc))
-                except IsADirectoryError:
-                    pass
+def parse_manifest(lines, fmt='auto', base=''):
+    # Yields a FileObj per manifest entry while reading, so huge manifests
+    # are never held in memory. Relative paths are taken from base, the
+    # manifest's directory.
+    for path, algorithm, expected in manifest.read_entries(lines, fmt):
+        yield FileObj(os.path.join(base, path), expected=expected,
+                      algorithm=algorithm)
+
+
+def parse_sfv(lines):
+    return parse_manifest(lines, 'sfv')
+
+
+def read_manifests(files):
+    # Chains the entries of several manifests (SFV, *sum or BSD style)
+    # into one stream.
+    for file_in in files:
+        try:
+            with open(file_in, 'r') as f:
+                name = os.fspath(file_in)
+                yield from parse_manifest(f, manifest.format_for(name),
+                                          os.path.dirname(name))
+        except (IsADirectoryError, FileNotFoundError, UnicodeDecodeError) \
+                as err:
+            print(err)
+
+
+def hash_expected(record):
+    if record.algorithm == 'crc32':
+        return hash_record(record)
+    return hash_record(record, algorithms=(record.algorithm,))
+
+
+def verify_sfv_file(file_in, jobs=1):
+    verify_manifests([file_in], jobs)
+
+
+def verify_manifests(files, jobs=1):
+    verify_sfv_entries(read_manifests(files), jobs)
+
+
+def verify_sfv_entries(entries, jobs=1):
+    total_files = ok_files = corrupt = not_found = unreadable = 0
+    for record, pending in workers.imap_ordered(hash_expected, entries, jobs,
+                                                prefetch=prefetch):
+        cur_file = record.path
+        total_files += 1
+        try:
+            calc_crc = pending.result().digest()
+            if(calc_crc == record.expected):
+                cur_file = cur_file[cur_file.rfind('/') + 1:]
+                print('{}:\nFile OK\n'.format(cur_file))
+                ok_files += 1
             else:
+                cur_file = cur_file[cur_file.rfind('/') + 1:]
+                print('{}:\nCorrupt file\n'.format(cur_file))
+                corrupt += 1
+        except FileNotFoundError:
+            print(cur_file + ':')
+            print('No such file or directory: {}'.format(cur_file))
+            not_found += 1
+        except OSError as err:
+            print(cur_file + ':')
+            print('{}: {}\n'.format(err.strerror or err, cur_file))
+            unreadable += 1
+    print('\nSummary:\n Total - {}\n'.format(total_files),
+          'OK - {}\n'.format(ok_files),
+          'Corrupt - {}\n'.format(corrupt),
+          'Not Found - {}\n'.format(not_found),
+          'Unreadable - {}'.format(unreadable))
+
+
+def sidecar_names(sfv_filename, algorithms):
+    # crc32 goes to the named SFV file and every other digest to a
+    # coreutils-style file next to it (out.sfv -> out.md5, out.sha256, ...).
+    base = splitext(sfv_filename)[0]
+    return [(name, sfv_filename if name == 'crc32'
+             else '{}.{}'.format(base, name)) for name in algorithms]
+
+
+def _sidecar_line(name, record):
+    if name == 'crc32':
+        return manifest.writers['sfv'](name, record.path, record.crc)
+    return manifest.writers['gnu'](name, record.path, record.digests[name])
+
+
+def sfv_header():
+    ctime = datetime.now().strftime('%A, %d %B %Y @ %I:%M %p')
+    nline = '\n;'
+    char = 'charset=UTF-8'
+    hasht = 'Hash type: CRC-32'
+    return '; Created by SFV Master 1.2{1} {0}{1} {2}{1} {3}{1}\n'.format(
+        ctime,
+        nline,
+        char,
+        hasht)
+
+
+def update_sfv_file(sfv_filename, changes):
+    # Applies {path: crc} to an existing .sfv (a crc of None drops the
+    # entry) and rewrites it in place. Untouched entries keep their order.
+    entries = {}
+    try:
+        with open(sfv_filename, encoding='utf-8') as sfv_file:
+            for path, _, crc in manifest.read_entries(sfv_file, 'sfv'):
+                entries[path] = crc
+    except FileNotFoundError:
+        pass
+    for path, crc in changes.items():
+        if crc is None:
+            entries.pop(path, None)
+        else:
+            entries[path] = crc
+    tmp_name = sfv_filename + '.tmp'
+    with open(tmp_name, encoding='utf-8', mode='w') as buf:
+        buf.write(sfv_header())
+        buf.write(''.join(manifest.writers['sfv']('crc32', path, crc)
+                          for path, crc in entries.items()))
+    os.replace(tmp_name, sfv_filename)
+
+
+def _file_id(st):
+    return st.st_dev, st.st_ino
+
+
+def _is_one_of(record, ids):
+    if record.stat is None:
+        try:
+            record.stat = os.stat(record.path)
+        except OSError:
+            return False
+    return _file_id(record.stat) in ids
+
+
+def create_sfv_file(sfv_filename, in_files, jobs=1, algorithms=('crc32',)):
+    algorithms = tuple(algorithms)
+    outputs = sidecar_names(sfv_filename, algorithms)
+    for _, name in outputs:
+        print('Creating {}...'.format(name))
+    with ExitStack() as stack:
+        bufs = {}
+        for alg, name in outputs:
+            bufs[alg] = stack.enter_context(open(name, encoding='utf-8',
+                                                 mode='w+',
+                                                 buffering=1024 * 1024))
+        if 'crc32' in bufs:
+            bufs['crc32'].write(sfv_header())
+        # The files being written, by inode, so ./out.sfv is skipped as
+        # well as out.sfv.
+        skip = {_file_id(os.fstat(buf.fileno())) for buf in bufs.values()}
+        in_files = (record for record in map(as_record, in_files)
+                    if record.path[-4:] != '.sfv' and
+                    not _is_one_of(record, skip) and not record.is_dir())
+        if algorithms == ('crc32',):
+            hash_fn = hash_record
+        else:
+            hash_fn = partial(hash_record, algorithms=algorithms)
+        # imap_ordered is the reorder buffer: results come back in input
+        # order and a slow file at the head stops new submissions instead
+        # of letting finished results pile up behind it.
+        lines = {alg: [] for alg in algorithms}
+        for record, pending in workers.imap_ordered(hash_fn,
+                                                    in_files, jobs,
+                                                    prefetch=prefetch):
+            try:
+                record = pending.result()
+                for alg in algorithms:
+                    lines[alg].append(_sidecar_line(alg, record))
+            except IsADirectoryError:
                 pass
+            if len(lines[algorithms[0]]) >= sfv_batch_lines:
+                for alg in algorithms:
+                    bufs[alg].write(''.join(lines[alg]))
+                    lines[alg] = []
+        for alg in algorithms:
+            bufs[alg].write(''.join(lines[alg]))
     print('Done')
@@ -0,0 +1,84 @@
+import os
+import struct
+from functools import lru_cache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOWR('f', 11, struct fiemap) from linux/fs.h.
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap header followed by one struct fiemap_extent.
+fiemap_header = struct.Struct('=QQIIII')
+fiemap_extent = struct.Struct('=QQQQQIIII')
+
+
+@lru_cache(maxsize=None)
+def is_rotational(st_dev):
+    # Reads /sys/dev/block/MAJ:MIN/queue/rotational, looking at the parent
+    # disk for partitions. Returns None when it can't be told (not Linux,
+    # network and virtual filesystems, ...).
+    sysdir = '/sys/dev/block/{}:{}'.format(os.major(st_dev),
+                                           os.minor(st_dev))
+    for path in (sysdir, os.path.join(sysdir, '..')):
+        try:
+            with open(os.path.join(path, 'queue', 'rotational')) as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+
+def physical_offset(path):
+    # Physical byte offset of the first extent via the FIEMAP ioctl, or
+    # None if the filesystem doesn't support it.
+    if fcntl is None:
+        return None
+    buf = bytearray(fiemap_header.size + fiemap_extent.size)
+    fiemap_header.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if not fiemap_header.unpack_from(buf, 0)[3]:
+        return None
+    return fiemap_extent.unpack_from(buf, fiemap_header.size)[1]
+
+
+def physical_key(item, index):
+    # Sort key putting files on rotational disks in on-disk order (FIEMAP,
+    # falling back to inode number) ahead of everything else, which keeps
+    # its input order.
+    st = getattr(item, 'stat', None)
+    if st is None or not is_rotational(st.st_dev):
+        return (1, 0, 0, index)
+    offset = physical_offset(os.fspath(item))
+    if offset is None:
+        return (0, st.st_dev, 1, st.st_ino)
+    return (0, st.st_dev, 0, offset)
+
+
+class DeviceLimits:
+    # How many files may be read at once from each device (st_dev). Mount
+    # point overrides win; otherwise rotational disks get one reader and
+    # everything else gets `default`.
+
+    def __init__(self, default, overrides=None):
+        self.default = default
+        self.overrides = {}
+        for mount, jobs in (overrides or {}).items():
+            self.overrides[os.stat(mount).st_dev] = jobs
+
+    def limit(self, st_dev):
+        if st_dev in self.overrides:
+            return self.overrides[st_dev]
+        if st_dev is not None and is_rotational(st_dev):
+            return 1
+        return self.default
@@ -0,0 +1,91 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# Event masks from linux/inotify.h.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+event_header = struct.Struct('iIII')
+
+
+def _libc():
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+
+
+def available():
+    try:
+        return hasattr(_libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+
+class Inotify:
+    # Minimal ctypes binding: add_watch() paths, then read() batches of
+    # (wd, mask, cookie, name) events.
+
+    def __init__(self):
+        self._libc = _libc()
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        # Returns [] if nothing arrived within timeout seconds.
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except InterruptedError:
+            return []
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = event_header.unpack_from(data, pos)
+            pos += event_header.size
+            name = os.fsdecode(data[pos:pos + size].rstrip(b'\0'))
+            pos += size
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
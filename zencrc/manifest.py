@@ -0,0 +1,114 @@
+import re
+from os.path import basename, splitext
+
+# Checksum manifest readers and writers. Readers turn one line into a
+# (path, algorithm, expected digest) tuple, or None for comments and lines
+# they don't understand; writers turn a digest back into a line.
+
+bsd_names = {'crc32': 'CRC32', 'md5': 'MD5', 'sha1': 'SHA1',
+             'sha224': 'SHA224', 'sha256': 'SHA256', 'sha384': 'SHA384',
+             'sha512': 'SHA512'}
+hex_lengths = {32: 'md5', 40: 'sha1', 56: 'sha224', 64: 'sha256',
+               96: 'sha384', 128: 'sha512'}
+bsd_regex = re.compile(r'([\w-]+) ?\((.*)\) ?= ?([0-9a-fA-F]+)')
+gnu_regex = re.compile(r'(\\?)([0-9a-fA-F]+) [ *](.*)')
+
+
+def _normalise(algorithm, digest):
+    return digest.upper() if algorithm == 'crc32' else digest.lower()
+
+
+def read_sfv_line(line):
+    line = line.rstrip()
+    if(len(line) != 0 and line[0] != ';'):
+        crc = line[line.rfind(" ") + 1:]
+        return line[0:-9], 'crc32', crc.upper()
+    return None
+
+
+def read_bsd_line(line):
+    match = bsd_regex.fullmatch(line.rstrip('\r\n'))
+    if match is None:
+        return None
+    algorithm = match.group(1).lower().replace('-', '')
+    if algorithm not in bsd_names:
+        return None
+    return match.group(2), algorithm, _normalise(algorithm, match.group(3))
+
+
+def _unescape(path):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                  else m.group(1), path)
+
+
+def read_gnu_line(line):
+    match = gnu_regex.fullmatch(line.rstrip('\r\n'))
+    if match is None or len(match.group(2)) not in hex_lengths:
+        return None
+    path = match.group(3)
+    if match.group(1):
+        path = _unescape(path)
+    algorithm = hex_lengths[len(match.group(2))]
+    return path, algorithm, match.group(2).lower()
+
+
+def read_any_line(line):
+    stripped = line.strip()
+    if not stripped or stripped[0] in ';#':
+        return None
+    return read_bsd_line(line) or read_gnu_line(line) or read_sfv_line(line)
+
+
+readers = {
+    'sfv': read_sfv_line,
+    'bsd': read_bsd_line,
+    'gnu': read_gnu_line,
+    'auto': read_any_line,
+}
+
+
+def format_for(filename):
+    # .sfv files keep the strict SFV parser; everything else is detected
+    # line by line, so one file may even mix formats.
+    return 'sfv' if splitext(filename)[1].lower() == '.sfv' else 'auto'
+
+
+def is_manifest(filename):
+    # .sfv, .md5, .sha256sum, ... and coreutils-style SHA256SUMS, MD5SUMS.
+    name = basename(filename).lower()
+    ext = splitext(name)[1][1:]
+    if ext == 'sfv' or ext in bsd_names or ext[:-3] in bsd_names and \
+            ext.endswith('sum'):
+        return True
+    return name.endswith('sums') and name[:-4] in bsd_names
+
+
+def read_entries(lines, fmt='auto'):
+    # Lazily parses an iterable of lines, so huge manifests stream.
+    reader = readers[fmt]
+    for line in lines:
+        entry = reader(line)
+        if entry is not None:
+            yield entry
+
+
+def write_sfv_line(algorithm, path, digest):
+    return '{} {}\n'.format(path, digest)
+
+
+def write_gnu_line(algorithm, path, digest):
+    if '\\' in path or '\n' in path:
+        path = path.replace('\\', '\\\\').replace('\n', '\\n')
+        return '\\{}  {}\n'.format(digest, path)
+    return '{}  {}\n'.format(digest, path)
+
+
+def write_bsd_line(algorithm, path, digest):
+    return '{} ({}) = {}\n'.format(bsd_names[algorithm], path, digest)
+
+
+writers = {
+    'sfv': write_sfv_line,
+    'gnu': write_gnu_line,
+    'bsd': write_bsd_line,
+}
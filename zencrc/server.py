@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import signal
+import socket
+import sqlite3
+import argparse
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from zencrc import cache, client, crc32, workers, zencrc_cli
+
+# Subcommands that can't run inside the server.
+local_commands = ('serve', 'watch', 'client')
+
+
+class StreamWriter:
+    # Stands in for stdout or stderr during a request and sends each write
+    # to the client as it happens.
+
+    def __init__(self, conn, stream):
+        self.conn = conn
+        self.stream = stream
+
+    def write(self, text):
+        if text:
+            client.send(self.conn, **{self.stream: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def exit_code(exc):
+    if exc.code is None:
+        return 0
+    return exc.code if isinstance(exc.code, int) else 1
+
+
+class Server:
+    # Runs the CLI for one request at a time over a Unix socket. Requests
+    # are {"argv": [...], "cwd": ...} lines; replies are {"out": text} and
+    # {"err": text} lines and a final {"exit": code}. The hash cache and
+    # thread pools stay open between requests, and every request starts
+    # from the settings the server was started with.
+
+    def __init__(self, path=None):
+        self.path = path or client.socket_path()
+        workers.warm_pools = {}
+        try:
+            crc32.cache = cache.HashCache()
+        except (OSError, sqlite3.Error) as err:
+            print('Hash cache disabled: {}'.format(err))
+        self.crc32_settings = crc32.settings()
+
+    def listen(self):
+        if os.path.exists(self.path):
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(self.path)
+                raise OSError('already serving on {}'.format(self.path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        sock = socket.socket(socket.AF_UNIX)
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        return sock
+
+    def handle(self, conn):
+        request = json.loads(conn.makefile('rb').readline() or b'{}')
+        argv = request.get('argv', [])
+        if argv[:1] and argv[0] in local_commands:
+            client.send(conn, err='zencrc {} cannot run in the server\n'
+                        .format(argv[0]))
+            client.send(conn, exit=2)
+            return
+        code = 0
+        cwd = os.getcwd()
+        try:
+            os.chdir(request.get('cwd', cwd))
+            with redirect_stdout(StreamWriter(conn, 'out')), \
+                    redirect_stderr(StreamWriter(conn, 'err')):
+                try:
+                    zencrc_cli.main(argv, renice=False)
+                except SystemExit as exc:
+                    code = exit_code(exc)
+                except (BrokenPipeError, ConnectionResetError):
+                    raise
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+        finally:
+            os.chdir(cwd)
+            crc32.configure(self.crc32_settings)
+        client.send(conn, exit=code)
+
+    def serve_forever(self):
+        with self.listen() as sock:
+            print('Serving on {}'.format(self.path))
+            try:
+                while True:
+                    conn, _ = sock.accept()
+                    with conn:
+                        try:
+                            self.handle(conn)
+                        except (OSError, ValueError) as err:
+                            print('Request failed: {}'.format(err))
+            finally:
+                os.unlink(self.path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='zencrc serve',
+        description='Answer zencrc client requests over a Unix socket')
+
+    parser.add_argument('--socket',
+                        default=client.socket_path(),
+                        help='socket path (default $ZENCRC_SOCKET, then '
+                             '$XDG_RUNTIME_DIR/zencrc.sock)')
+
+    args = parser.parse_args(argv)
+
+    # Exit through serve_forever's cleanup, which removes the socket.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # A request with --throttle-file leaves this installed; between such
+    # requests it does nothing rather than killing the server.
+    signal.signal(signal.SIGUSR1, zencrc_cli.reload_throttle)
+    try:
+        Server(args.socket).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except OSError as err:
+        parser.error(str(err))
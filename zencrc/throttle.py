@@ -0,0 +1,114 @@
+import os
+import time
+import threading
+
+rate_units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_amount(text):
+    # '200M' -> 209715200, '500' -> 500. Raises ValueError.
+    text = text.strip().upper().replace('/S', '').rstrip('B')
+    if text and text[-1] in rate_units:
+        return int(float(text[:-1]) * rate_units[text[-1]])
+    return int(text)
+
+
+class TokenBucket:
+    # Allows `rate` units per second on average with bursts of up to one
+    # second's worth. Callers may run into debt; they then sleep it off
+    # outside the lock, so concurrent callers share the rate fairly.
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate or 0
+        self.tokens = self.rate
+        self.stamp = time.monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate or 0
+            self.tokens = min(self.tokens, self.rate)
+
+    def consume(self, amount):
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Throttle:
+    # Byte and I/O rate limits shared by every worker thread. With a
+    # control file, limits are re-read when it changes (checked at most
+    # once a second) or when reload() is called, e.g. from SIGUSR1.
+    # The file holds lines like "max-rate 100M" and "max-iops 500"; 0 or
+    # a missing line means unlimited. A throttle for one of `parts`
+    # processes applies 1/parts of every limit read from the file.
+
+    def __init__(self, max_rate=None, max_iops=None, control_file=None,
+                 parts=1):
+        self.bytes = TokenBucket(max_rate)
+        self.iops = TokenBucket(max_iops)
+        self.control_file = control_file
+        self.parts = parts
+        self.checked = 0
+        self.mtime = None
+        self.reload_requested = False
+
+    def __getstate__(self):
+        return {'max_rate': self.bytes.rate, 'max_iops': self.iops.rate,
+                'control_file': self.control_file, 'parts': self.parts}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _part(self, rate, parts):
+        return rate and max(rate // parts, 1)
+
+    def share(self, parts):
+        # A throttle for one of `parts` processes splitting these limits.
+        return Throttle(self._part(self.bytes.rate, parts),
+                        self._part(self.iops.rate, parts),
+                        self.control_file, self.parts * parts)
+
+    def reload(self, *args):
+        self.reload_requested = True
+
+    def _check_control_file(self):
+        now = time.monotonic()
+        if not self.reload_requested and now - self.checked < 1:
+            return
+        self.checked = now
+        force, self.reload_requested = self.reload_requested, False
+        try:
+            mtime = os.stat(self.control_file).st_mtime_ns
+            if mtime == self.mtime and not force:
+                return
+            self.mtime = mtime
+            with open(self.control_file) as f:
+                limits = dict(line.split(None, 1) for line in f
+                              if line.strip() and not line.startswith('#'))
+            for bucket, name in ((self.bytes, 'max-rate'),
+                                 (self.iops, 'max-iops')):
+                rate = parse_amount(limits.get(name, '0'))
+                bucket.set_rate(self._part(rate, self.parts))
+        except (OSError, ValueError):
+            pass
+
+    def charge(self, nbytes):
+        if self.control_file is not None:
+            self._check_control_file()
+        self.iops.consume(1)
+        self.bytes.consume(nbytes)
+
+
+def throttled(chunks, throttle):
+    for chunk in chunks:
+        throttle.charge(len(chunk))
+        yield chunk
@@ -0,0 +1,222 @@
+import os
+import hashlib
+import sqlite3
+import argparse
+from zencrc import cache, crc32, inotify, manifest, workers, zencrc_cli
+
+watch_mask = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+              inotify.IN_MOVED_FROM | inotify.IN_DELETE | inotify.IN_CREATE)
+# Files queued before a batch is hashed even if events keep coming.
+max_batch = 1024
+
+
+def cursor_path(dirs):
+    # One cursor per set of watched directories, next to the hash cache.
+    key = '\0'.join(sorted(os.path.abspath(d) for d in dirs))
+    name = 'watch-{}.cursor'.format(
+        hashlib.sha1(os.fsencode(key)).hexdigest()[:16])
+    return os.path.join(os.path.dirname(cache.default_path()), name)
+
+
+def changed_at(st):
+    # ctime too, so files moved in with an old mtime still count as new.
+    return max(st.st_mtime_ns, st.st_ctime_ns)
+
+
+class Watcher:
+    # Hashes files under dirs as they are closed after writing or moved
+    # in. The cursor is the newest change time hashed so far; on start and
+    # after an event queue overflow, files changed since then are rescanned.
+
+    def __init__(self, dirs, append=False, sfv_name=None, jobs=1,
+                 settle=2.0, cursor_file=None):
+        self.dirs = dirs
+        self.append = append
+        self.sfv_name = sfv_name
+        self.jobs = jobs
+        self.settle = settle
+        self.cursor_file = cursor_file or cursor_path(dirs)
+        self.cursor = self.load_cursor()
+        self.notifier = inotify.Inotify()
+        self.wds = {}
+        self.pending = {}
+
+    def load_cursor(self):
+        try:
+            with open(self.cursor_file) as cursor_file:
+                return int(cursor_file.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def save_cursor(self):
+        os.makedirs(os.path.dirname(self.cursor_file), exist_ok=True)
+        tmp_name = self.cursor_file + '.tmp'
+        with open(tmp_name, 'w') as cursor_file:
+            cursor_file.write('{}\n'.format(self.cursor))
+        os.replace(tmp_name, self.cursor_file)
+
+    def add_tree(self, top):
+        for dirpath, _, _ in os.walk(top):
+            try:
+                wd = self.notifier.add_watch(dirpath, watch_mask)
+            except OSError as err:
+                print(err)
+                continue
+            self.wds[wd] = dirpath
+
+    def drop_tree(self, top):
+        prefix = top + os.sep
+        for wd, path in list(self.wds.items()):
+            if path == top or path.startswith(prefix):
+                self.notifier.rm_watch(wd)
+                del self.wds[wd]
+
+    def ignored(self, path):
+        # Checksum files, including the ones written here, aren't hashed.
+        name = os.path.basename(path)
+        if name.endswith('.tmp'):
+            name = name[:-4]
+        if name == self.sfv_name or manifest.is_manifest(name):
+            return True
+        # Our own renames come back as IN_MOVED_TO.
+        return self.append and crc32.CRC_from_filename(path) is not None
+
+    def queue(self, path, action='hash'):
+        if not self.ignored(path):
+            self.pending[path] = action
+
+    def catch_up(self, dirs, since):
+        for record in zencrc_cli.expand_dirs(dirs):
+            if record.stat is not None and changed_at(record.stat) > since:
+                self.queue(record.path)
+
+    def handle(self, wd, mask, name):
+        if mask & inotify.IN_Q_OVERFLOW:
+            print('Event queue overflowed, rescanning')
+            self.catch_up(self.dirs, self.cursor)
+            return
+        if mask & inotify.IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        base = self.wds.get(wd)
+        if base is None or not name:
+            return
+        path = os.path.join(base, name)
+        if mask & inotify.IN_ISDIR:
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.add_tree(path)
+                self.catch_up([path], 0)
+            elif mask & inotify.IN_MOVED_FROM:
+                self.drop_tree(path)
+        elif mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+            self.queue(path)
+        elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.queue(path, 'delete')
+
+    def flush(self):
+        sfv_changes = {}
+        records = []
+        for path, action in self.pending.items():
+            if action == 'delete':
+                sfv_changes.setdefault(os.path.dirname(path), {})[
+                    os.path.basename(path)] = None
+                continue
+            record = crc32.FileObj.from_path(path)
+            if record.stat is not None and not record.is_dir():
+                records.append(record)
+        self.pending = {}
+        for record, pending in workers.imap_ordered(crc32.hash_record,
+                                                    records, self.jobs,
+                                                    prefetch=crc32.prefetch):
+            try:
+                done = pending.result()
+            except OSError as err:
+                print(err)
+                continue
+            path = record.path
+            if self.append:
+                path = crc32.append_to_filename(record, pending) or path
+            else:
+                print('{} {}'.format(path, done.crc))
+            sfv_changes.setdefault(os.path.dirname(path), {})[
+                os.path.basename(path)] = done.crc
+            self.cursor = max(self.cursor, changed_at(record.stat))
+        if self.sfv_name:
+            for dirpath, changes in sfv_changes.items():
+                try:
+                    crc32.update_sfv_file(
+                        os.path.join(dirpath, self.sfv_name), changes)
+                except OSError as err:
+                    print(err)
+        self.save_cursor()
+
+    def run(self):
+        for top in self.dirs:
+            self.add_tree(top)
+        # Watches are in place before the scan, so nothing falls between.
+        self.catch_up(self.dirs, self.cursor)
+        print('Watching {} ...'.format(', '.join(self.dirs)))
+        with self.notifier:
+            while True:
+                if self.pending and len(self.pending) >= max_batch:
+                    self.flush()
+                timeout = self.settle if self.pending else None
+                events = self.notifier.read(timeout)
+                for wd, mask, _, name in events:
+                    self.handle(wd, mask, name)
+                if not events and self.pending:
+                    self.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='zencrc watch',
+        description='Hash files under DIR as they arrive')
+
+    parser.add_argument('-a',
+                        '--append',
+                        action='store_true',
+                        help='append CRC32 to new file names')
+
+    parser.add_argument('-s',
+                        '--sfv',
+                        metavar='NAME',
+                        help='keep a NAME .sfv file up to date in each '
+                             'directory')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of files to hash at once')
+
+    parser.add_argument('--settle',
+                        type=float,
+                        default=2.0,
+                        help='seconds without events before queued files '
+                             'are hashed')
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='do not use the on-disk hash cache')
+
+    parser.add_argument('dir', nargs='+', help='Directory to watch')
+
+    args = parser.parse_args(argv)
+
+    if not inotify.available():
+        parser.error('inotify is not available on this system')
+    for top in args.dir:
+        if not os.path.isdir(top):
+            parser.error('not a directory: {}'.format(top))
+    if not args.no_cache:
+        try:
+            crc32.cache = cache.HashCache()
+        except (OSError, sqlite3.Error) as err:
+            print('Hash cache disabled: {}'.format(err))
+    watcher = Watcher(args.dir, args.append, args.sfv, args.jobs,
+                      args.settle)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.save_cursor()
@@ -0,0 +1,386 @@
+import os
+import heapq
+import time
+import itertools
+import threading
+import collections
+from zencrc import devices
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+
+# 'thread' or 'process'.
+default_executor = 'thread'
+# Items sent to a worker process per task.
+process_batch_size = 16
+# Run in each worker process before it takes any work, so settings made in
+# the parent also apply under the spawn and forkserver start methods.
+process_initializer = None
+process_initargs = ()
+# 'fifo' hashes in input order, 'largest' starts the biggest files first
+# and 'physical' reads files on rotational disks in on-disk order.
+default_schedule = 'fifo'
+# Called as schedule_report(fifo, scheduled, seconds) after a reordered
+# run, with the estimated makespans in bytes per worker.
+schedule_report = None
+# The HelpBoard of the running reordered schedule, if any.
+board = None
+# A devices.DeviceLimits giving each device its own pool, or None for one
+# pool of `jobs` threads.
+device_limits = None
+# Items read ahead of the oldest unfinished one when each device has its
+# own pool, so a later device's files start while an earlier device is
+# still busy. Bounds the results held back for input order.
+device_lookahead = 4096
+# Finished results a reordered schedule may hold back for input order
+# before workers only take the oldest unfinished item.
+reorder_window = 1024
+# Thread pools kept by size and reused by later calls (zencrc serve sets
+# this to {}), or None to start a pool per call.
+warm_pools = None
+
+
+_end = object()
+
+
+def completed(fn, *args):
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as err:
+        future.set_exception(err)
+    return future
+
+
+def _lookahead(items):
+    items = iter(items)
+    for current in items:
+        for upcoming in items:
+            yield current, upcoming
+            current = upcoming
+        yield current, None
+
+
+def _batched(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _run_batch(fn, batch):
+    results = []
+    for item in batch:
+        try:
+            results.append((True, fn(item)))
+        except Exception as err:
+            results.append((False, err))
+    return results
+
+
+def _unbatch(batch, future):
+    try:
+        results = future.result()
+    except Exception as err:
+        results = [(False, err)] * len(batch)
+    for item, (ok, value) in zip(batch, results):
+        done = Future()
+        if ok:
+            done.set_result(value)
+        else:
+            done.set_exception(value)
+        yield item, done
+
+
+def _imap_processes(fn, items, jobs, window, prefetch):
+    # Items go to the processes in batches to keep pickling and IPC
+    # overhead low; results come back per item in input order.
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=process_initializer,
+                             initargs=process_initargs) as pool:
+        for batch in _batched(items, process_batch_size):
+            if prefetch is not None:
+                for item in batch:
+                    prefetch(item)
+            pending.append((batch, pool.submit(_run_batch, fn, batch)))
+            if len(pending) >= window:
+                yield from _unbatch(*pending.popleft())
+        while pending:
+            yield from _unbatch(*pending.popleft())
+
+
+class HelpBoard:
+    # Jobs that idle workers can help with. A job has a help() method that
+    # does one piece of work and returns False once nothing is left.
+
+    def __init__(self):
+        self.jobs = []
+        self.cond = threading.Condition()
+
+    def post(self, job):
+        with self.cond:
+            self.jobs.append(job)
+            self.cond.notify_all()
+
+    def remove(self, job):
+        with self.cond:
+            self.jobs.remove(job)
+
+    def help(self):
+        with self.cond:
+            jobs = list(self.jobs)
+        return any(job.help() for job in jobs)
+
+
+def item_stat(item):
+    # Stats items that don't carry a stat yet (e.g. manifest entries) and
+    # keeps the result for the hashing stage.
+    if getattr(item, 'stat', 1) is None:
+        try:
+            item.stat = os.stat(item.path)
+        except OSError:
+            pass
+    return getattr(item, 'stat', None)
+
+
+def item_size(item):
+    st = item_stat(item)
+    return st.st_size if st is not None else 0
+
+
+def makespan(sizes, jobs):
+    # Greedy list scheduling: each size goes to the least loaded worker.
+    loads = [0] * jobs
+    for size in sizes:
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads)
+
+
+def largest_key(item, index):
+    return -item_size(item)
+
+
+schedule_keys = {
+    'largest': largest_key,
+    'physical': devices.physical_key,
+}
+
+
+def _imap_reordered(fn, items, jobs, key, limits=None, window=None):
+    # Starts items in the order given by key(item, index) (which needs the
+    # whole list up front) and, once no items are left to start, lets idle
+    # workers help with the ranges of large files still in progress.
+    # Results are still yielded in input order; once `window` finished
+    # results wait for an earlier one, workers only take the oldest item
+    # not yet yielded, so held results stay bounded. With limits (a
+    # devices.DeviceLimits) each device gets its own readers and a worker
+    # takes the next item, in schedule order, whose device has one free;
+    # helping is off then, as it would add readers to a device.
+    global board
+    items = list(items)
+    sizes = [item_size(item) for item in items]
+    planned = sorted(range(len(items)), key=lambda i: key(items[i], i))
+    rank = {index: n for n, index in enumerate(planned)}
+    devices = [item_device(item) if limits is not None else None
+               for item in items]
+    queues = collections.defaultdict(collections.deque)
+    for index in planned:
+        queues[devices[index]].append(index)
+    if limits is None:
+        readers = {None: jobs}
+    else:
+        readers = {dev: max(limits.limit(dev), 1) for dev in queues}
+    busy = collections.Counter()
+    window = window or reorder_window
+    queued = set(planned)
+    actual_order = []
+    # Finished results not yet yielded, and the next index to yield.
+    held = [0]
+    head = [0]
+    futures = [Future() for _ in items]
+    running = [0]
+    started = time.monotonic()
+    helpers = HelpBoard()
+    if limits is None:
+        board = helpers
+
+    def take():
+        # Called with helpers.cond held.
+        if held[0] >= window:
+            index = head[0]
+            dev = devices[index] if index < len(items) else None
+            if index not in queued or busy[dev] >= readers[dev]:
+                return None
+            queues[dev].remove(index)
+        else:
+            free = [dev for dev, queue in queues.items()
+                    if queue and busy[dev] < readers[dev]]
+            if not free:
+                return None
+            dev = min(free, key=lambda dev: rank[queues[dev][0]])
+            index = queues[dev].popleft()
+        queued.discard(index)
+        busy[dev] += 1
+        actual_order.append(index)
+        return index
+
+    def worker():
+        while True:
+            with helpers.cond:
+                index = take()
+                if index is not None:
+                    running[0] += 1
+            if index is not None:
+                try:
+                    futures[index].set_result(fn(items[index]))
+                except Exception as err:
+                    futures[index].set_exception(err)
+                with helpers.cond:
+                    running[0] -= 1
+                    held[0] += 1
+                    busy[devices[index]] -= 1
+                    helpers.cond.notify_all()
+            elif limits is not None or not helpers.help():
+                with helpers.cond:
+                    if not running[0] and not any(queues.values()):
+                        return
+                    helpers.cond.wait(0.1)
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(sum(readers.values()))]
+    for thread in threads:
+        thread.start()
+    try:
+        for index, (item, future) in enumerate(zip(items, futures)):
+            future.exception()
+            with helpers.cond:
+                held[0] -= 1
+                head[0] = index + 1
+                helpers.cond.notify_all()
+            yield item, future
+    finally:
+        with helpers.cond:
+            for queue in queues.values():
+                queue.clear()
+            queued.clear()
+        for thread in threads:
+            thread.join()
+        board = None
+    if schedule_report is not None:
+        schedule_report(makespan(sizes, jobs),
+                        makespan([sizes[i] for i in actual_order], jobs),
+                        time.monotonic() - started)
+
+
+def item_device(item):
+    st = item_stat(item)
+    return st.st_dev if st is not None else None
+
+
+def _imap_devices(fn, items, limits, window, prefetch):
+    # Each device has its own queue and pool, sized by limits.limit(st_dev),
+    # and at most twice its pool size in flight, so a busy HDD array can't
+    # hold up an NVMe disk in the same run. Up to `window` items are read
+    # ahead; results are yielded in input order.
+    items = iter(items)
+    pools = {}
+    depth = {}
+    queues = {}
+    running = {}
+    busy = collections.Counter()
+    results = collections.deque()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(results) < window:
+                item = next(items, _end)
+                if item is _end:
+                    exhausted = True
+                    break
+                dev = item_device(item)
+                if dev not in pools:
+                    size = max(limits.limit(dev), 1)
+                    pools[dev] = ThreadPoolExecutor(max_workers=size)
+                    depth[dev] = size * 2
+                    queues[dev] = collections.deque()
+                slot = [item, None]
+                queues[dev].append(slot)
+                results.append(slot)
+            for dev, queue in queues.items():
+                while queue and busy[dev] < depth[dev]:
+                    slot = queue.popleft()
+                    if prefetch is not None:
+                        prefetch(slot[0])
+                    slot[1] = pools[dev].submit(fn, slot[0])
+                    running[slot[1]] = dev
+                    busy[dev] += 1
+            while results and results[0][1] is not None and \
+                    results[0][1].done():
+                yield tuple(results.popleft())
+            if not results:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                busy[running.pop(future)] -= 1
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+
+def imap_ordered(fn, items, jobs=1, window=None, prefetch=None,
+                 executor=None, schedule=None):
+    # Yields (item, future) pairs in input order. At most `window` items
+    # (batches, for processes) are in flight at once so results never pile
+    # up in memory. `prefetch` is called with each item shortly before it
+    # is hashed. Reordered schedules and per-device pools always run
+    # threads.
+    schedule = schedule or default_schedule
+    if schedule != 'fifo':
+        limits = device_limits
+        if limits is None and schedule == 'physical':
+            # Physical order only pays off with one reader per spinning
+            # disk, and stealing ranges would seek between files.
+            limits = devices.DeviceLimits(max(jobs, 1))
+        yield from _imap_reordered(fn, items, max(jobs, 1),
+                                   schedule_keys[schedule], limits, window)
+        return
+    if device_limits is not None:
+        yield from _imap_devices(fn, items, device_limits,
+                                 window or device_lookahead, prefetch)
+        return
+    if jobs <= 1:
+        if prefetch is None:
+            for item in items:
+                yield item, completed(fn, item)
+            return
+        for item, upcoming in _lookahead(items):
+            if upcoming is not None:
+                prefetch(upcoming)
+            yield item, completed(fn, item)
+        return
+    if (executor or default_executor) == 'process':
+        yield from _imap_processes(fn, items, jobs, window or jobs * 2,
+                                   prefetch)
+        return
+    window = window or jobs * 4
+    if warm_pools is not None:
+        if jobs not in warm_pools:
+            warm_pools[jobs] = ThreadPoolExecutor(max_workers=jobs)
+        yield from _imap_pool(fn, items, warm_pools[jobs], window, prefetch)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        yield from _imap_pool(fn, items, pool, window, prefetch)
+
+
+def _imap_pool(fn, items, pool, window, prefetch):
+    pending = collections.deque()
+    for item in items:
+        if prefetch is not None:
+            prefetch(item)
+        pending.append((item, pool.submit(fn, item)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
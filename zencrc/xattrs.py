@@ -0,0 +1,28 @@
+import os
+
+attr_name = 'user.zencrc.crc32'
+
+
+def supported():
+    return hasattr(os, 'setxattr')
+
+
+def read(file, st):
+    # Returns the stored CRC only if the file still has the size and mtime
+    # it had when the CRC was computed.
+    try:
+        value = os.getxattr(file, attr_name).decode('ascii')
+        crc, size, mtime_ns = value.split()
+        if int(size) == st.st_size and int(mtime_ns) == st.st_mtime_ns:
+            return crc
+    except (AttributeError, OSError, UnicodeDecodeError, ValueError):
+        pass
+    return None
+
+
+def write(file, st, crc):
+    value = '{} {} {}'.format(crc, st.st_size, st.st_mtime_ns)
+    try:
+        os.setxattr(file, attr_name, value.encode('ascii'))
+    except (AttributeError, OSError):
+        pass
@@ -3,25 +3,182 @@
 # SFV Master ver 1.0 Beta
 
 import os
+import re
+import sys
+import signal
+import sqlite3
 import argparse
-from zencrc import crc32
+import functools
+import multiprocessing
+from zencrc import (blockmap, cache, crc32, devices, manifest, throttle,
+                    workers, xattrs)
 
 
-def expand_dirs(dirlist):
-    master_filelist = []
+def parse_size(text):
+    try:
+        return throttle.parse_amount(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(text))
+
+
+def format_size(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024
+    return '{:.1f}T'.format(size)
+
+
+def print_schedule_report(fifo, scheduled, seconds):
+    print('Schedule: makespan {} per worker (FIFO would be {}),'
+          ' finished in {:.1f}s'.format(format_size(scheduled),
+                                       format_size(fifo), seconds))
+
+
+def reload_throttle(signum, frame):
+    # SIGUSR1: re-read the throttle file here and in any worker processes.
+    if crc32.throttle is None:
+        return
+    crc32.throttle.reload()
+    for child in multiprocessing.active_children():
+        try:
+            os.kill(child.pid, signum)
+        except OSError:
+            pass
+
+
+def init_worker(settings):
+    crc32.configure(settings)
+    if crc32.throttle is not None and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, crc32.throttle.reload)
+
+
+def parse_device_jobs(text):
+    mount, _, jobs = text.rpartition('=')
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        jobs = 0
+    if not mount or jobs < 1:
+        raise argparse.ArgumentTypeError(
+            'expected MOUNT=N, got {}'.format(text))
+    return mount, jobs
+
+
+def parse_range(text):
+    start, sep, end = text.partition(':')
+    try:
+        start, end = parse_size(start or '0'), parse_size(end)
+    except argparse.ArgumentTypeError:
+        sep = None
+    if not sep or end <= start:
+        raise argparse.ArgumentTypeError(
+            'expected START:END, got {}'.format(text))
+    return start, end
+
+
+def parse_pattern(text):
+    try:
+        return re.compile(text, re.I)
+    except re.error as err:
+        raise argparse.ArgumentTypeError('invalid pattern: {}'.format(err))
+
+
+def parse_hash_list(text):
+    names = [name.strip().lower() for name in text.split(',') if name.strip()]
+    for name in names:
+        if name not in crc32.hash_algorithms:
+            raise argparse.ArgumentTypeError(
+                'unknown hash {} (choose from {})'.format(
+                    name, ', '.join(crc32.hash_algorithms)))
+    if not names:
+        raise argparse.ArgumentTypeError('no hash given')
+    return tuple(dict.fromkeys(names))
+
+
+def _entry_record(entry):
+    try:
+        return crc32.FileObj(entry.path, entry.stat())
+    except OSError:
+        return crc32.FileObj(entry.path)
+
+
+def _scan_dir(top, st, follow_symlinks, detect_cycles):
+    # Depth-first and top-down like os.walk, but lazy: files are yielded
+    # as each directory is read. Each stack item carries the (st_dev,
+    # st_ino) keys of the directories above it for cycle detection.
+    stack = [(top, frozenset([(st.st_dev, st.st_ino)]))]
+    while stack:
+        path, ancestors = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        yield _entry_record(entry)
+                    elif follow_symlinks or not entry.is_symlink():
+                        subdirs.append(entry)
+        except OSError:
+            continue
+        for entry in reversed(subdirs):
+            if not detect_cycles:
+                stack.append((entry.path, ancestors))
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key not in ancestors:
+                stack.append((entry.path, ancestors | {key}))
+
+
+def expand_dirs(dirlist, follow_symlinks=False, detect_cycles=True):
+    # Yields a crc32.FileObj, carrying the stat result, for every file
+    # under the given directories and for every other argument.
     for i in dirlist:
-        if os.path.isdir(i):
-            for parent_dir, _, files in os.walk(i):
-                for i in range(len(files)):
-                    file_path = os.path.join(parent_dir, files[i])
-                    master_filelist.append(file_path)
+        record = crc32.FileObj.from_path(i)
+        if record.is_dir():
+            yield from _scan_dir(i, record.stat, follow_symlinks,
+                                 detect_cycles)
         else:
-            master_filelist.append(i)
-    return master_filelist
+            yield record
+
+
+class FileList:
+    # Re-iterable list of crc32.FileObj records, built again for each mode.
+
+    def __init__(self, paths, recurse=False, **options):
+        self.paths = paths
+        self.recurse = recurse
+        self.options = options
 
+    def __iter__(self):
+        if self.recurse:
+            return expand_dirs(self.paths, **self.options)
+        return map(crc32.FileObj.from_path, self.paths)
 
-def main():
-    parser = argparse.ArgumentParser(description='ZenCRC ver 0.8 Beta')
+
+def main(argv=None, renice=True):
+    if argv is None:
+        argv = sys.argv[1:]
+    # Imported here: these modules use this one's walker and main().
+    if argv[:1] == ['watch']:
+        from zencrc import watch
+        return watch.main(argv[1:])
+    if argv[:1] == ['serve']:
+        from zencrc import server
+        return server.main(argv[1:])
+    if argv[:1] == ['client']:
+        from zencrc import client
+        return client.main(argv)
+
+    parser = argparse.ArgumentParser(prog='zencrc',
+                                     description='ZenCRC ver 0.8 Beta')
 
     parser.add_argument('-a',
                         '--append',
@@ -37,58 +194,294 @@ def main():
                         '--sfv',
                         help='Create a .sfv file')
 
+    parser.add_argument('--hash',
+                        type=parse_hash_list,
+                        default=('crc32',),
+                        help='digests written by --sfv in one pass, '
+                             'e.g. crc32,md5,sha256')
+
     parser.add_argument('-c',
                         '--checksfv',
                         action='store_true',
-                        help='Verify a .sfv file')
+                        help='Verify .sfv, *sum or BSD-style checksum files')
+
+    parser.add_argument('-m',
+                        '--crcmap',
+                        action='store_true',
+                        help='write a FILE.crcmap with a CRC32 per block')
+
+    parser.add_argument('-M',
+                        '--check-crcmap',
+                        action='store_true',
+                        help='verify files against their .crcmap and report '
+                             'damaged byte ranges')
+
+    parser.add_argument('--block-size',
+                        type=parse_size,
+                        help='bytes per block in new .crcmap files '
+                             '(default {})'.format(
+                                 format_size(blockmap.default_block_size)))
+
+    parser.add_argument('--changed',
+                        type=parse_range,
+                        action='append',
+                        default=[],
+                        metavar='START:END',
+                        help='with --crcmap, only reread blocks in this '
+                             'byte range of changed files (may be repeated)')
+
+    parser.add_argument('-f',
+                        '--follow',
+                        action='store_true',
+                        help='hash file(s) while they are being written and '
+                             'print the CRC32 once each is closed')
+
+    parser.add_argument('--idle',
+                        type=float,
+                        default=10.0,
+                        help='with --follow, seconds without writes after '
+                             'which a file counts as finished')
 
     parser.add_argument('-r',
                         '--recurse',
                         action='store_true',
                         help='Run program recursively')
 
+    parser.add_argument('--crc-pattern',
+                        type=parse_pattern,
+                        help='regex finding the CRC in file names; group 1 '
+                             '(or the whole match) is the CRC')
+
+    parser.add_argument('-L',
+                        '--follow-symlinks',
+                        action='store_true',
+                        help='follow symlinked directories when recursing')
+
+    parser.add_argument('--chunk-size',
+                        type=parse_size,
+                        default=crc32.default_chunk_size,
+                        help='read size used while hashing (e.g. 4M)')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help='number of files to hash at once')
+
+    parser.add_argument('--executor',
+                        choices=['thread', 'process'],
+                        default=workers.default_executor,
+                        help='run --jobs workers as threads or processes')
+
+    parser.add_argument('--schedule',
+                        choices=['fifo', 'largest', 'physical'],
+                        default=workers.default_schedule,
+                        help='hash files in input order, largest first, or '
+                             'in on-disk order on rotational disks')
+
+    parser.add_argument('--per-device',
+                        action='store_true',
+                        help='limit concurrency per device: one reader for '
+                             'rotational disks, --jobs for others')
+
+    parser.add_argument('--device-jobs',
+                        type=parse_device_jobs,
+                        action='append',
+                        default=[],
+                        metavar='MOUNT=N',
+                        help='readers for the device holding MOUNT '
+                             '(implies --per-device, may be repeated)')
+
+    parser.add_argument('--split-jobs',
+                        type=int,
+                        default=crc32.split_jobs,
+                        help='hash ranges of one large file at once')
+
+    parser.add_argument('--split-threshold',
+                        type=parse_size,
+                        default=crc32.split_threshold,
+                        help='smallest file hashed in ranges (e.g. 1G)')
+
+    parser.add_argument('--engine',
+                        choices=sorted(crc32.engines),
+                        default=crc32.default_engine,
+                        help='how file data is read while hashing')
+
+    parser.add_argument('--max-rate',
+                        type=parse_size,
+                        help='limit reads to this many bytes per second '
+                             'across all workers (e.g. 200M)')
+
+    parser.add_argument('--max-iops',
+                        type=int,
+                        help='limit reads to this many chunks per second '
+                             'across all workers')
+
+    parser.add_argument('--throttle-file',
+                        help='file with "max-rate N" / "max-iops N" lines, '
+                             're-read when it changes or on SIGUSR1')
+
+    parser.add_argument('--nice',
+                        type=int,
+                        help='raise the CPU niceness by this much '
+                             '(default 10 when throttling)')
+
+    parser.add_argument('--no-cache-pollution',
+                        nargs='?',
+                        const='dontneed',
+                        choices=['dontneed', 'direct'],
+                        dest='cache_policy',
+                        help='keep hashed data out of the page cache with '
+                             'fadvise DONTNEED (default) or O_DIRECT reads')
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='do not use the on-disk hash cache')
+
+    parser.add_argument('--refresh-cache',
+                        action='store_true',
+                        help='rehash every file and update the hash cache')
+
+    parser.add_argument('--resume-appends',
+                        action='store_true',
+                        help='only hash the new end of files that grew '
+                             'since the last run (uses the hash cache)')
+
+    xattr_group = parser.add_mutually_exclusive_group()
+    xattr_group.add_argument('--trust-xattr',
+                             action='store_const',
+                             dest='xattr_policy',
+                             const='trust',
+                             help='use CRCs stored in user.zencrc.crc32 '
+                                  'when size and mtime still match')
+
+    xattr_group.add_argument('--rehash',
+                             action='store_const',
+                             dest='xattr_policy',
+                             const='rehash',
+                             help='read every file again and update '
+                                  'user.zencrc.crc32 and the hash cache')
+
     parser.add_argument('file', nargs='+', help='Input File')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.changed and (not args.crcmap or len(args.file) != 1 or
+                         os.path.isdir(args.file[0])):
+        # The ranges describe one file's edits; other files would keep
+        # stale block CRCs for whatever else changed in them.
+        parser.error('--changed needs --crcmap and exactly one file')
 
-    filelist = args.file
+    filelist = FileList(args.file, args.recurse,
+                        follow_symlinks=args.follow_symlinks)
+    crc32.default_chunk_size = args.chunk_size
+    crc32.crc_pattern = args.crc_pattern
+    crc32.split_jobs = args.split_jobs
+    crc32.split_threshold = args.split_threshold
+    crc32.default_engine = args.engine
+    crc32.cache_policy = args.cache_policy
+    crc32.xattr_policy = args.xattr_policy
+    if args.xattr_policy and not xattrs.supported():
+        print('Extended attributes are not supported here; '
+              'only the hash cache is used')
+        crc32.xattr_policy = None
+    crc32.resume_appends = args.resume_appends
+    if args.no_cache:
+        crc32.cache = None
+    else:
+        # A cache already open (zencrc serve keeps one) is reused.
+        refresh = args.refresh_cache or args.xattr_policy == 'rehash'
+        if crc32.cache is None or crc32.cache.refresh != refresh:
+            try:
+                crc32.cache = cache.HashCache(refresh=refresh)
+            except (OSError, sqlite3.Error) as err:
+                print('Hash cache disabled: {}'.format(err))
+    crc32.throttle = None
+    if args.max_rate or args.max_iops or args.throttle_file:
+        crc32.throttle = throttle.Throttle(args.max_rate, args.max_iops,
+                                           args.throttle_file)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, reload_throttle)
+        if args.nice is None:
+            args.nice = 10
+    if args.nice and renice:
+        try:
+            os.nice(args.nice)
+        except (AttributeError, OSError):
+            pass
+    if args.executor == 'process' and args.schedule != 'fifo':
+        parser.error('--schedule {} runs threads; it cannot be used with '
+                     '--executor process'.format(args.schedule))
+    if args.executor == 'process' and (args.per_device or args.device_jobs):
+        parser.error('--per-device and --device-jobs run threads; they '
+                     'cannot be used with --executor process')
+    workers.default_executor = args.executor
+    workers.default_schedule = args.schedule
+    workers.schedule_report = print_schedule_report
+    workers.device_limits = None
+    if args.per_device or args.device_jobs:
+        try:
+            workers.device_limits = devices.DeviceLimits(
+                args.jobs, dict(args.device_jobs))
+        except OSError as err:
+            parser.error('--device-jobs: {}'.format(err))
+    workers.process_initializer = init_worker
+    settings = crc32.settings()
+    if crc32.throttle is not None and args.executor == 'process':
+        settings['throttle'] = crc32.throttle.share(max(args.jobs, 1))
+    workers.process_initargs = (settings,)
 
-    if args.recurse:
-        filelist = expand_dirs(filelist)
+    if args.follow:
+        follow = functools.partial(crc32.follow_CRC32, idle=args.idle)
+        for i, pending in workers.imap_ordered(follow, args.file,
+                                               len(args.file),
+                                               executor='thread',
+                                               schedule='fifo'):
+            try:
+                print('{} {}'.format(i, pending.result()[0]))
+            except OSError as err:
+                print(err)
 
     if args.verify:
         try:
             print('Verify Mode:\n')
             print('{:50s}{:20s}{:8s}'.format('Filename', 'Status', 'CRC32'))
-            for i in filelist:
-                if os.path.isdir(i):
-                    continue
-                else:
-                    crc32.verify_in_filename(i)
+            files = (i for i in filelist if not i.is_dir())
+            for i, pending in workers.imap_ordered(crc32.hash_record,
+                                                   files, args.jobs,
+                                                   prefetch=crc32.prefetch):
+                crc32.verify_in_filename(i, pending)
         except FileNotFoundError as err:
             print(err)
 
     if args.append:
         try:
             print('Append Mode:')
-            for i in filelist:
-                if os.path.isdir(i):
-                    continue
-                else:
-                    crc32.append_to_filename(i)
+            files = (i for i in filelist if not i.is_dir())
+            for i, pending in workers.imap_ordered(crc32.hash_unless_named,
+                                                   files, args.jobs,
+                                                   prefetch=crc32.prefetch):
+                crc32.append_to_filename(i, pending)
         except FileNotFoundError:
             pass
 
     if args.sfv:
-        crc32.create_sfv_file(args.sfv, filelist)
+        crc32.create_sfv_file(args.sfv, filelist, args.jobs, args.hash)
+
+    if args.crcmap:
+        blockmap.create_maps(filelist, args.jobs, args.changed,
+                             args.block_size)
+
+    if args.check_crcmap:
+        blockmap.verify_maps(filelist, args.jobs)
 
     if args.checksfv:
-        try:
-            for i in filelist:
-                crc32.verify_sfv_file(i)
-        except IsADirectoryError as err:
-            print(err)
+        # Every manifest is verified in one pass. When recursing, only
+        # files that look like manifests are read as such.
+        manifests = (i for i in filelist if not args.recurse or
+                     manifest.is_manifest(i.path))
+        crc32.verify_manifests(manifests, args.jobs)
 
 
 if (__name__ == '__main__'):
-        main()
+        sys.exit(main())